@@ -1,8 +1,14 @@
-from fastapi import FastAPI, Depends, HTTPException, Header, status
-from pydantic import BaseModel
+from fastapi import FastAPI, Depends, HTTPException, Header, Request, status
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ValidationError
 from jose import JWTError, jwt
-from clickhouse_driver import Client
-import os, time, datetime
+import clickhouse_connect
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc
+import zstandard
+import os, sys, time, asyncio, functools, hmac
 import uvicorn
 
 # ------------------------------------------------------------------
@@ -12,41 +18,259 @@ JWT_SECRET        = os.getenv("AUTH_SHARED_SECRET", "my-secret-key")
 JWT_ALGORITHM     = "HS256"
 RAW_SHARED_TOKEN  = os.getenv("AUTH_STATIC_TOKEN", "optional-static-token")
 CLICKHOUSE_HOST   = os.getenv("CLICKHOUSE_HOST", "127.0.0.1")
+CLICKHOUSE_PORT   = int(os.getenv("CLICKHOUSE_PORT", "8123"))
 CLICKHOUSE_DB     = os.getenv("CLICKHOUSE_DB", "metrics")
 CLICKHOUSE_USER   = os.getenv("CLICKHOUSE_USER", "default")
 CLICKHOUSE_PASS   = os.getenv("CLICKHOUSE_PASSWORD", "")
 SCRAPER_USER      = os.getenv("SCRAPER_USER", "user")
 SCRAPER_PASS      = os.getenv("SCRAPER_PASS", "pass")
+BATCH_MAX         = int(os.getenv("INGEST_BATCH_MAX", "50000"))
+FLUSH_INTERVAL    = float(os.getenv("INGEST_FLUSH_INTERVAL", "1.0"))
+QUEUE_MAX_BYTES   = int(os.getenv("INGEST_QUEUE_MAX_BYTES", str(256 * 1024 * 1024)))
+INSERT_ATTEMPTS   = int(os.getenv("INGEST_INSERT_ATTEMPTS", "8"))
+RETRY_MAX_DELAY   = float(os.getenv("INGEST_RETRY_MAX_DELAY", "30"))
+SHUTDOWN_RETRIES  = 3
+DEAD_LETTER_DIR   = os.getenv("INGEST_DEAD_LETTER_DIR")
+WEB_WORKERS       = int(os.getenv("UVICORN_WORKERS", os.cpu_count() or 1))
+INIT_SCHEMA       = os.getenv("INIT_SCHEMA") == "1"
+MAX_INFLATED_BODY = int(os.getenv("INGEST_MAX_BODY_BYTES", str(64 * 1024 * 1024)))
+MAX_COMPRESSED_BODY = int(os.getenv("INGEST_MAX_COMPRESSED_BYTES", str(8 * 1024 * 1024)))
 
 # ------------------------------------------------------------------
 # ClickHouse connection
 # ------------------------------------------------------------------
-ch = Client(
-    host=CLICKHOUSE_HOST,
-    database=CLICKHOUSE_DB,
-    user=CLICKHOUSE_USER,
-    password=CLICKHOUSE_PASS
-)
-
-# Create table if it doesn’t exist
-ch.execute("""
-CREATE TABLE IF NOT EXISTS container_metrics (
-    ts             DateTime,
-    cluster        String,
-    node           String,
-    namespace      String,
-    pod            String,
-    container      String,
-    cpu_usage_sec  Float64,
-    mem_usage_b    UInt64
-) ENGINE = MergeTree()
-ORDER BY (ts, cluster, node, namespace, pod, container)
-""")
+# clickhouse-connect (HTTP interface) so inserts can ship Arrow buffers
+# as-is instead of per-cell Python values. get_client() queries the server,
+# so it is created on first use (the first flush, or --init-db) rather than
+# at import: workers start without a round trip and still import while
+# ClickHouse is briefly down. A failed connect is not cached and is retried
+# with the insert.
+@functools.lru_cache(maxsize=None)
+def get_ch():
+    return clickhouse_connect.get_client(
+        host=CLICKHOUSE_HOST,
+        port=CLICKHOUSE_PORT,
+        database=CLICKHOUSE_DB,
+        username=CLICKHOUSE_USER,
+        password=CLICKHOUSE_PASS
+    )
+
+# Create table if it doesn’t exist. Not run at import: every worker (and
+# every reload) would repeat the round trip. Run once per deployment via
+# `python3 app.py --init-db` or INIT_SCHEMA=1 (done in the parent process
+# before workers are spawned).
+def init_schema():
+    get_ch().command("""
+    CREATE TABLE IF NOT EXISTS container_metrics (
+        ts             DateTime,
+        cluster        String,
+        node           String,
+        namespace      String,
+        pod            String,
+        container      String,
+        cpu_usage_sec  Float64,
+        mem_usage_b    UInt64
+    ) ENGINE = MergeTree()
+    ORDER BY (ts, cluster, node, namespace, pod, container)
+    """)
+
+SCHEMA = pa.schema([
+    ("ts",            pa.timestamp("s")),
+    ("cluster",       pa.string()),
+    ("node",          pa.string()),
+    ("namespace",     pa.string()),
+    ("pod",           pa.string()),
+    ("container",     pa.string()),
+    ("cpu_usage_sec", pa.float64()),
+    ("mem_usage_b",   pa.uint64()),
+])
+
+# ------------------------------------------------------------------
+# Ingest buffer
+# ------------------------------------------------------------------
+# /ingest only enqueues Arrow tables; a single background task merges
+# them into batches of up to BATCH_MAX rows (or whatever arrived within
+# FLUSH_INTERVAL seconds) so MergeTree sees few large parts. Queued and
+# in-flight tables may hold at most QUEUE_MAX_BYTES of Arrow buffers per
+# worker: when ClickHouse is slow or down, /ingest answers 503 with
+# Retry-After instead of buffering without limit (metric-scraper honours it).
+ingest_queue: asyncio.Queue = asyncio.Queue()
+buffered_bytes = 0
+shutting_down = asyncio.Event()
+flusher_task = None
+
+def build_table(records):
+    # Structure of arrays: numeric columns go into preallocated typed
+    # NumPy buffers that Arrow wraps without copying
+    n = len(records)
+    ts = np.empty(n, np.int64)  # epoch seconds
+    cpu = np.empty(n, np.float64)
+    mem = np.empty(n, np.uint64)
+    cluster, node, ns, pod, cont = [None] * n, [None] * n, [None] * n, [None] * n, [None] * n
+    for i, r in enumerate(records):
+        ts[i] = r.ts
+        cluster[i] = r.cluster
+        node[i] = r.node
+        ns[i] = r.namespace
+        pod[i] = r.pod
+        cont[i] = r.container
+        cpu[i] = r.cpu_usage_sec
+        mem[i] = r.mem_usage_b
+    columns = [ts, cluster, node, ns, pod, cont, cpu, mem]
+    return pa.Table.from_arrays(
+        [pa.array(col, type=field.type) for col, field in zip(columns, SCHEMA)],
+        schema=SCHEMA,
+    )
+
+def insert_tables(tables):
+    get_ch().insert_arrow("container_metrics", pa.concat_tables(tables))
+
+def dead_letter(batch, rows, error):
+    # Keep the batch as an Arrow IPC stream that /ingest_raw accepts as-is,
+    # so it can be replayed once the cause is fixed
+    if not DEAD_LETTER_DIR:
+        print(f"❌ Dropping {rows} rows: {error}")
+        return
+    path = os.path.join(DEAD_LETTER_DIR, f"batch-{time.time_ns()}-{os.getpid()}.arrow")
+    try:
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_stream(sink, SCHEMA) as writer:
+            for table in batch:
+                writer.write_table(table)
+    except OSError as e:
+        print(f"❌ Dropping {rows} rows: {error} (dead-letter write failed: {e})")
+        return
+    print(f"❌ Failed to insert {rows} rows: {error}; saved to {path}")
+
+async def insert_with_retry(loop, batch, rows):
+    # Rows were already acknowledged to clients, so a failed insert is
+    # retried with exponential backoff. After INSERT_ATTEMPTS (or
+    # SHUTDOWN_RETRIES once shutting down) the batch is dead-lettered, so a
+    # batch ClickHouse keeps rejecting cannot stall the only flusher.
+    delay, attempt = 0.5, 0
+    while True:
+        attempt += 1
+        try:
+            # the ClickHouse client is blocking; keep the event loop free
+            await loop.run_in_executor(None, insert_tables, batch)
+            return
+        except Exception as e:
+            if attempt >= (SHUTDOWN_RETRIES if shutting_down.is_set() else INSERT_ATTEMPTS):
+                await loop.run_in_executor(None, dead_letter, batch, rows, e)
+                return
+            print(f"❌ Failed to insert {rows} rows (attempt {attempt}), retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RETRY_MAX_DELAY)
+
+async def flush_loop():
+    global buffered_bytes
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        table = await ingest_queue.get()
+        if table is None:  # shutdown sentinel
+            break
+        batch, rows = [table], table.num_rows
+        deadline = loop.time() + FLUSH_INTERVAL
+        while rows < BATCH_MAX:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                more = await asyncio.wait_for(ingest_queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if more is None:
+                stopping = True
+                break
+            batch.append(more)
+            rows += more.num_rows
+        await insert_with_retry(loop, batch, rows)
+        buffered_bytes -= sum(table.nbytes for table in batch)
+
+def enqueue(table):
+    global buffered_bytes
+    if buffered_bytes + table.nbytes > QUEUE_MAX_BYTES:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Ingest buffer full", headers={"Retry-After": "1"})
+    buffered_bytes += table.nbytes
+    ingest_queue.put_nowait(table)
 
 # ------------------------------------------------------------------
 # FastAPI setup
 # ------------------------------------------------------------------
-app = FastAPI()
+class ZstdRequestMiddleware:
+    """Inflate request bodies sent with `Content-Encoding: zstd` before routing.
+
+    Auth is checked first and the compressed body is capped, so an
+    unauthenticated client cannot make the server inflate anything.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (b"content-encoding", b"zstd") not in scope["headers"]:
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        try:
+            auth_guard(headers.get(b"authorization", b"").decode("latin-1"))
+        except HTTPException as e:
+            return await reject(scope, receive, send, e.status_code, e.detail)
+        if int(headers.get(b"content-length", 0)) > MAX_COMPRESSED_BODY:
+            return await reject(scope, receive, send, 413, "Body too large")
+
+        chunks, size, more = [], 0, True
+        while more:
+            message = await receive()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > MAX_COMPRESSED_BODY:
+                return await reject(scope, receive, send, 413, "Body too large")
+            chunks.append(chunk)
+            more = message.get("more_body", False)
+        try:
+            # One bounded pass: inflate at most one byte past the limit,
+            # whether or not the frame header records its size
+            with zstandard.ZstdDecompressor().stream_reader(b"".join(chunks)) as reader:
+                body = reader.read(MAX_INFLATED_BODY + 1)
+        except zstandard.ZstdError:
+            return await reject(scope, receive, send, 400, "Bad zstd body")
+        if len(body) > MAX_INFLATED_BODY:
+            return await reject(scope, receive, send, 413, "Body too large")
+
+        headers = [(k, v) for k, v in scope["headers"]
+                   if k not in (b"content-encoding", b"content-length")]
+        headers.append((b"content-length", str(len(body)).encode()))
+        delivered = False
+
+        async def receive_inflated():
+            nonlocal delivered
+            if delivered:
+                return await receive()
+            delivered = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        await self.app(dict(scope, headers=headers), receive_inflated, send)
+
+async def reject(scope, receive, send, status_code, detail):
+    response = ORJSONResponse({"detail": detail}, status_code=status_code)
+    await response(scope, receive, send)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(ZstdRequestMiddleware)
+
+@app.on_event("startup")
+async def start_flusher():
+    global flusher_task
+    flusher_task = asyncio.create_task(flush_loop())
+
+@app.on_event("shutdown")
+async def stop_flusher():
+    # Let the flusher write whatever is still buffered before exiting
+    shutting_down.set()
+    await ingest_queue.put(None)
+    await flusher_task
 
 # -------------- models --------------
 class AuthRequest(BaseModel):
@@ -54,7 +278,7 @@ class AuthRequest(BaseModel):
     password: str
 
 class MetricsSample(BaseModel):
-    ts: float                     # epoch seconds
+    ts: float                     # epoch seconds (scrapers send ints)
     cluster: str
     node: str
     namespace: str
@@ -67,19 +291,28 @@ class MetricsPayload(BaseModel):
     records: list[MetricsSample]
 
 # -------------- auth helpers --------------
+@functools.lru_cache(maxsize=1024)
+def _decode(token: str):
+    # Cached per raw token; expiry is re-checked by the caller on every hit
+    payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    return payload.get("sub"), payload.get("exp")  # username, expiry
+
 def verify_jwt_token(token: str):
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload.get("sub")  # username
+        sub, exp = _decode(token)
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Invalid or expired token")
+    if exp is not None and exp <= time.time():
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Invalid or expired token")
+    return sub
 
 def auth_guard(authorization: str = Header(...)):
     scheme, _, token = authorization.partition(" ")
     if scheme.lower() != "bearer":
         raise HTTPException(status_code=401, detail="Bad auth header")
-    if RAW_SHARED_TOKEN and token == RAW_SHARED_TOKEN:
+    if RAW_SHARED_TOKEN and hmac.compare_digest(token.encode(), RAW_SHARED_TOKEN.encode()):
         return "static-client"
     return verify_jwt_token(token)
 
@@ -97,18 +330,39 @@ def authenticate(req: AuthRequest):
     return {"access_token": token, "token_type": "bearer", "expires_in": 3600}
 
 @app.post("/ingest")
-def ingest(payload: MetricsPayload, client_id: str = Depends(auth_guard)):
-    rows = [
-        (datetime.datetime.fromtimestamp(r.ts),
-         r.cluster, r.node, r.namespace, r.pod, r.container,
-         r.cpu_usage_sec, r.mem_usage_b)
-        for r in payload.records
-    ]
-    ch.execute("INSERT INTO container_metrics VALUES", rows, types_check=True)
-    return {"inserted": len(rows)}
+async def ingest(request: Request, client_id: str = Depends(auth_guard)):
+    # Validate the raw body in pydantic-core (JSON parse + model build in
+    # Rust) instead of letting FastAPI decode it to dicts first
+    try:
+        payload = MetricsPayload.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False))
+    enqueue(build_table(payload.records))
+    return {"queued": len(payload.records)}
+
+@app.post("/ingest_raw")
+async def ingest_raw(request: Request, client_id: str = Depends(auth_guard)):
+    # Trusted bulk path: body is an Arrow IPC stream with the SCHEMA
+    # columns (ts as epoch seconds or timestamp[s]); it is forwarded to
+    # ClickHouse without ever becoming Python objects
+    try:
+        table = pa.ipc.open_stream(await request.body()).read_all()
+        table = table.select(SCHEMA.names).cast(SCHEMA)
+    except (pa.ArrowException, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Bad Arrow payload: {e}")
+    enqueue(table)
+    return {"queued": table.num_rows}
 
 # ------------------------------------------------------------------
 # Main entry for python3 app.py
 # ------------------------------------------------------------------
 if __name__ == "__main__":
-    uvicorn.run("app:app", host="0.0.0.0", port=8082, reload=False)
+    if "--init-db" in sys.argv:
+        init_schema()
+        sys.exit(0)
+    if INIT_SCHEMA:
+        init_schema()
+    # Each worker is its own process with its own ClickHouse client and
+    # ingest buffer/flusher
+    uvicorn.run("app:app", host="0.0.0.0", port=8082, reload=False,
+                loop="uvloop", http="httptools", workers=WEB_WORKERS)
@@ -1,13 +1,17 @@
 import os
 import subprocess
 import sys
+import stat
+import tempfile
 import time
-import socket
 import requests
-import re
-from datetime import datetime, timezone
-from collections import defaultdict
+import numpy as np
+import orjson
+import zstandard
+from concurrent.futures import ThreadPoolExecutor
 from kubernetes import client, config
+from clickhouse_driver import Client
+from metrics_parser import SESSION, CADVISOR_RE, container_key, iter_metric_lines, find_free_ports, parse_ksm
 
 # ---------- Setup Cronjob (Optional) ----------
 def setup_cron():
@@ -34,30 +38,76 @@ PASSWORD = os.getenv("SCRAPER_PASS", "pass")
 AUTH_URL = os.getenv("AUTH_URL", "http://localhost:8082/auth")
 INGEST_URL = os.getenv("INGEST_URL", "http://localhost:8082/ingest")
 
+# ---------- Direct ClickHouse insert (trusted in-cluster scraper) ----------
+# When CLICKHOUSE_HOST is set, rows go straight to ClickHouse over the
+# native protocol instead of through the JWT-protected /ingest endpoint.
+CLICKHOUSE_HOST = os.getenv("CLICKHOUSE_HOST")
+CLICKHOUSE_DB = os.getenv("CLICKHOUSE_DB", "metrics")
+CLICKHOUSE_USER = os.getenv("CLICKHOUSE_USER", "default")
+CLICKHOUSE_PASS = os.getenv("CLICKHOUSE_PASSWORD", "")
+
+ch = Client(
+    host=CLICKHOUSE_HOST,
+    database=CLICKHOUSE_DB,
+    user=CLICKHOUSE_USER,
+    password=CLICKHOUSE_PASS
+) if CLICKHOUSE_HOST else None
+
+
+# The server issues 1h tokens while cron runs us every minute, so keep
+# the token on disk and only hit /auth when it is about to expire.
+TOKEN_CACHE = os.getenv("SCRAPER_TOKEN_CACHE") or os.path.join(
+    os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "metric-scraper", "jwt.json"
+)
+
+def load_cached_token():
+    # Only trust a regular file we own that nobody else can write; never
+    # follow a symlink planted at the cache path
+    try:
+        fd = os.open(TOKEN_CACHE, os.O_RDONLY | os.O_NOFOLLOW)
+        with os.fdopen(fd, "rb") as f:
+            st = os.fstat(f.fileno())
+            if st.st_uid != os.getuid() or st.st_mode & 0o022 or not stat.S_ISREG(st.st_mode):
+                return None
+            cached = orjson.loads(f.read())
+        if time.time() < cached["exp"] - 60:
+            return cached["token"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def save_cached_token(token, exp):
+    # Write a private temp file next to the cache and swap it in, so the
+    # path is never opened for writing and readers never see a partial file
+    cache_dir = os.path.dirname(TOKEN_CACHE)
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix=".jwt-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps({"token": token, "exp": exp}))
+        os.replace(tmp, TOKEN_CACHE)
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
 def get_jwt_token():
+    token = load_cached_token()
+    if token:
+        return token
     auth_payload = {"username": USERNAME, "password": PASSWORD}
     headers = {"Content-Type": "application/json"}
-    response = requests.post(AUTH_URL, json=auth_payload, headers=headers)
+    response = SESSION.post(AUTH_URL, data=orjson.dumps(auth_payload), headers=headers)
     if response.status_code != 200:
         raise Exception(f"Auth failed: {response.text}")
-    token = response.json().get("access_token")
+    body = orjson.loads(response.content)
+    token = body.get("access_token")
+    try:
+        save_cached_token(token, time.time() + body.get("expires_in", 3600))
+    except OSError as e:
+        print(f"Could not cache token: {e}")
     return token
 
 # ---------- Helpers ----------
-def parse_labels(label_str):
-    labels = {}
-    for part in label_str.split(','):
-        if '=' in part:
-            k, v = part.split('=', 1)
-            labels[k.strip()] = v.strip('"')
-    return labels
-
-def find_free_port():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind(('', 0))
-        return s.getsockname()[1]
-
 def get_running_cadvisor_pods(namespace='kube-system', label_selector='app=cadvisor'):
     config.load_kube_config()
     v1 = client.CoreV1Api()
@@ -68,8 +118,7 @@ def assign_ports_to_pods(pod_names, columns=5):
     assigned = {}
     row = 0
     col = 0
-    for pod in pod_names:
-        port = find_free_port()
+    for pod, port in zip(pod_names, find_free_ports(len(pod_names))):
         assigned[pod] = {'port': port, 'row': row, 'column': col}
         col += 1
         if col >= columns:
@@ -91,115 +140,152 @@ def start_port_forwards(namespace, assignments):
         procs.append((pod, proc))
     return procs
 
-def wait_for_port(port, timeout=10):
-    start = time.time()
-    while time.time() - start < timeout:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            result = sock.connect_ex(('localhost', port))
-            if result == 0:
+FETCH_WORKERS = 32
+
+def wait_for_cadvisor(port, timeout=10):
+    # An accepted TCP connect only proves kubectl is listening; poll the
+    # cAdvisor health endpoint through the tunnel instead
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if SESSION.get(f"http://localhost:{port}/healthz", timeout=1).status_code == 200:
                 return True
-        time.sleep(0.5)
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
     return False
 
+def wait_for_ports(ports, timeout=10):
+    ports = list(ports)
+    with ThreadPoolExecutor(max_workers=max(1, min(FETCH_WORKERS, len(ports)))) as pool:
+        return list(pool.map(lambda port: wait_for_cadvisor(port, timeout), ports))
+
+class Usage:
+    """One container's cAdvisor sample. __slots__ keeps it ~4x smaller than a dict."""
+    __slots__ = ("cpu", "mem", "ts")
+
+    def __init__(self):
+        self.cpu = None   # cumulative CPU seconds
+        self.mem = 0.0    # MiB
+        self.ts = None    # scrape time of the cpu sample
+
+def fetch_cadvisor_usage(url, timestamp):
+    usage = {}
+    try:
+        for line in iter_metric_lines(url):
+            m = CADVISOR_RE.match(line)
+            if not m:
+                continue
+            metric, label_part, value = m.groups()
+            ns, pod_name, container = container_key(label_part)
+            if not container or container in ("POD", ""):
+                continue
+            key = (ns, pod_name, container)
+            entry = usage.get(key)
+            if entry is None:
+                entry = usage[key] = Usage()
+            if metric == "container_cpu_usage_seconds_total":
+                entry.cpu = float(value)
+                entry.ts = timestamp
+            else:
+                entry.mem = float(value) / (1024 ** 2)  # bytes to MiB
+    except Exception:
+        return {}
+    return usage
+
 def fetch_cadvisor_metrics_multiple(pod_ports):
     usage = {}
     timestamp = time.time()
-    for pod, port in pod_ports.items():
-        try:
-            url = f"http://localhost:{port}/metrics"
-            metrics = requests.get(url, timeout=5).text.splitlines()
-        except Exception:
-            continue
-
-        for line in metrics:
-            if line.startswith("container_cpu_usage_seconds_total{"):
-                label_part = line.split('{', 1)[1].split('}', 1)[0]
-                labels = parse_labels(label_part)
-                ns = labels.get("namespace", labels.get("container_label_io_kubernetes_pod_namespace", ""))
-                pod_name = labels.get("pod", labels.get("container_label_io_kubernetes_pod_name", ""))
-                container = labels.get("container", labels.get("container_label_io_kubernetes_container_name", ""))
-                if not container or container in ("POD", ""):
-                    continue
-                value = float(line.split()[-2]) if len(line.split()) > 2 else float(line.split()[-1])
-                key = (ns, pod_name, container)
-                usage[key] = {"cpu": value, "timestamp": timestamp}
-
-            elif line.startswith("container_memory_usage_bytes{"):
-                label_part = line.split('{', 1)[1].split('}', 1)[0]
-                labels = parse_labels(label_part)
-                ns = labels.get("namespace", labels.get("container_label_io_kubernetes_pod_namespace", ""))
-                pod_name = labels.get("pod", labels.get("container_label_io_kubernetes_pod_name", ""))
-                container = labels.get("container", labels.get("container_label_io_kubernetes_container_name", ""))
-                if not container or container in ("POD", ""):
-                    continue
-                value = float(line.split()[-2]) if len(line.split()) > 2 else float(line.split()[-1])
-                key = (ns, pod_name, container)
-                if key not in usage:
-                    usage[key] = {}
-                usage[key]["memory"] = value / (1024 ** 2)
+    urls = [f"http://localhost:{port}/metrics" for port in pod_ports.values()]
+    # Each worker streams and parses one pod so network reads overlap parsing
+    with ThreadPoolExecutor(max_workers=max(1, min(FETCH_WORKERS, len(urls)))) as pool:
+        for pod_usage in pool.map(lambda url: fetch_cadvisor_usage(url, timestamp), urls):
+            usage.update(pod_usage)
     return usage
 
 def fetch_ksm():
-    lines = requests.get("http://localhost:8080/metrics").text.splitlines()
-    data = defaultdict(dict)
-    resource_pattern = re.compile(
-        r'kube_pod_container_resource_(requests|limits){.*?namespace="([^"]+)",pod="([^"]+)",.*?container="([^"]+)",.*?node="([^"]+)",.*?resource="(cpu|memory)".*?}\s+([0-9.e+-]+)'
-    )
-    pod_info_pattern = re.compile(
-        r'kube_pod_info{.*?namespace="([^"]+)",pod="([^"]+)",.*?node="([^"]+)".*?}\s+1'
-    )
-    owner_pattern = re.compile(
-        r'kube_pod_owner{[^}]*namespace="([^"]+)",pod="([^"]+)",[^}]*owner_kind="([^"]+)"[^}]*}\s+1'
-    )
-    for line in lines:
-        m = resource_pattern.match(line)
-        if m:
-            kind, ns, pod, container, node, resource, val = m.groups()
-            val = float(val)
-            if resource == "memory":
-                val /= 1024 ** 2
-            key = (ns, pod, container)
-            data[key][f"{resource}_{kind}"] = val
-            data[key]["node"] = node
-    for line in lines:
-        m = pod_info_pattern.match(line)
-        if m:
-            ns, pod, node = m.groups()
-            for key in data:
-                if key[0] == ns and key[1] == pod and "node" not in data[key]:
-                    data[key]["node"] = node
-    for line in lines:
-        m = owner_pattern.match(line)
-        if m:
-            ns, pod, owner_kind = m.groups()
-            for key in data:
-                if key[0] == ns and key[1] == pod:
-                    data[key]["owner"] = owner_kind
-    return data
+    return parse_ksm(iter_metric_lines("http://localhost:8080/metrics"))
+
+def cpu_rates(prev_metrics, curr_metrics):
+    # Align the containers seen in both scrapes, then compute every
+    # delta_cpu / delta_time in one vectorised divide
+    keys = [key for key in sorted(curr_metrics)
+            if key in prev_metrics and curr_metrics[key].cpu is not None and prev_metrics[key].cpu is not None]
+    n = len(keys)
+    cpu_prev = np.fromiter((prev_metrics[k].cpu for k in keys), np.float64, n)
+    cpu_curr = np.fromiter((curr_metrics[k].cpu for k in keys), np.float64, n)
+    t_prev = np.fromiter((prev_metrics[k].ts for k in keys), np.float64, n)
+    t_curr = np.fromiter((curr_metrics[k].ts for k in keys), np.float64, n)
+    dt = t_curr - t_prev
+    rates = np.divide(cpu_curr - cpu_prev, dt, out=np.zeros(n), where=dt > 0)
+    return zip(keys, rates.tolist())
+
+INGEST_ATTEMPTS = 5
+INGEST_RETRY_MAX_DELAY = 10
 
 def send_to_ingest(token, rows):
     headers = {
         "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
+        "Content-Type": "application/json",
+        "Content-Encoding": "zstd"
     }
     payload = {"records": rows}
-    response = requests.post(INGEST_URL, json=payload, headers=headers)
+    # orjson encodes the row list in C; zstd shrinks the highly repetitive
+    # cluster/namespace/pod strings several times over on the wire
+    body = zstandard.ZstdCompressor().compress(orjson.dumps(payload))
+    for attempt in range(1, INGEST_ATTEMPTS + 1):
+        response = SESSION.post(INGEST_URL, data=body, headers=headers)
+        # 503 means the ingest buffer is full; wait as long as it asks
+        if response.status_code != 503 or attempt == INGEST_ATTEMPTS:
+            break
+        try:
+            delay = min(float(response.headers.get("Retry-After", 1)), INGEST_RETRY_MAX_DELAY)
+        except ValueError:  # HTTP-date form
+            delay = 1
+        print(f"Ingest busy, retrying in {delay:.0f}s (attempt {attempt}/{INGEST_ATTEMPTS})")
+        time.sleep(delay)
+    if response.status_code == 401:
+        # Cached token was rejected (e.g. rotated secret); re-auth next run
+        try:
+            os.remove(TOKEN_CACHE)
+        except OSError:
+            pass
     if response.status_code != 200:
         print(f"Error ingesting data: {response.text}")
     else:
-        print(f"✅ Data sent successfully: {response.json()}")
+        print(f"✅ Data sent successfully: {orjson.loads(response.content)}")
+
+def insert_to_clickhouse(rows):
+    ts_col, cluster_col, node_col, ns_col = [], [], [], []
+    pod_col, cont_col, cpu_col, mem_col = [], [], [], []
+    for r in rows:
+        ts_col.append(r["ts"])
+        cluster_col.append(r["cluster"])
+        node_col.append(r["node"])
+        ns_col.append(r["namespace"])
+        pod_col.append(r["pod"])
+        cont_col.append(r["container"])
+        cpu_col.append(r["cpu_usage_sec"])
+        mem_col.append(r["mem_usage_b"])
+    ch.execute(
+        "INSERT INTO container_metrics "
+        "(ts,cluster,node,namespace,pod,container,cpu_usage_sec,mem_usage_b) VALUES",
+        [ts_col, cluster_col, node_col, ns_col, pod_col, cont_col, cpu_col, mem_col],
+        columnar=True,
+    )
+    print(f"✅ Inserted {len(ts_col)} rows into ClickHouse")
 
 # ---------- Main Execution ----------
 if __name__ == '__main__':
-    token = get_jwt_token()
+    token = None if ch else get_jwt_token()
     namespace = 'kube-system'
     pods = get_running_cadvisor_pods(namespace)
     assignments = assign_ports_to_pods(pods, columns=3)
     procs = start_port_forwards(namespace, assignments)
     pod_ports = {pod: info['port'] for pod, info in assignments.items()}
 
-    for pod, port in pod_ports.items():
-        wait_for_port(port, timeout=15)
+    # Probe every tunnel at once so startup costs one timeout, not N
+    wait_for_ports(pod_ports.values(), timeout=15)
 
     prev_metrics = fetch_cadvisor_metrics_multiple(pod_ports)
     time.sleep(30)
@@ -208,17 +294,11 @@ if __name__ == '__main__':
         curr_metrics = fetch_cadvisor_metrics_multiple(pod_ports)
         ksm_metrics = fetch_ksm()
         rows = []
-        now = datetime.now(timezone.utc).isoformat()
-
-        for key in sorted(curr_metrics):
-            if key not in prev_metrics or "cpu" not in curr_metrics[key] or "cpu" not in prev_metrics[key]:
-                continue
+        now_s = int(time.time())  # every row of one scrape shares the timestamp
 
+        for key, cpu in cpu_rates(prev_metrics, curr_metrics):
             ns, pod, container = key
-            delta_cpu = curr_metrics[key]["cpu"] - prev_metrics[key]["cpu"]
-            delta_time = curr_metrics[key]["timestamp"] - prev_metrics[key]["timestamp"]
-            cpu = delta_cpu / delta_time if delta_time > 0 else 0.0
-            mem = curr_metrics[key].get("memory", 0.0)
+            mem = curr_metrics[key].mem
 
             ksm = ksm_metrics.get(key, {})
             node = ksm.get("node", "unknown")
@@ -229,7 +309,7 @@ if __name__ == '__main__':
             mem_lim = ksm.get("memory_limits", 0.0)
 
             rows.append({
-                "ts": time.time(),
+                "ts": now_s,
                 "cluster": "my-cluster",
                 "node": node,
                 "namespace": ns,
@@ -239,7 +319,10 @@ if __name__ == '__main__':
                 "mem_usage_b": int(mem * 1024 * 1024)  # Convert MiB to bytes
             })
 
-        send_to_ingest(token, rows)
+        if ch:
+            insert_to_clickhouse(rows)
+        else:
+            send_to_ingest(token, rows)
 
     finally:
         for _, proc in procs:
@@ -0,0 +1,178 @@
+import re
+import socket
+import struct
+import asyncio
+import requests
+from collections import defaultdict
+
+# Shared fetch/parse primitives for the scraper scripts, so each
+# optimisation to the hot path lands in one place. The metric-scraper image
+# is built from the repo root so it can copy this file as well.
+
+# --- HTTP session ---
+# One keep-alive session for every HTTP call, so repeated scrapes of the
+# same endpoints reuse their connections instead of reconnecting each time.
+SESSION = requests.Session()
+SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_connections=64, pool_maxsize=64))
+SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=64, pool_maxsize=64))
+
+def iter_metric_lines(url, timeout=5):
+    # Stream the exposition text line by line instead of materialising
+    # .text and a splitlines() list of the whole body
+    with SESSION.get(url, stream=True, timeout=timeout) as response:
+        if response.encoding is None:
+            response.encoding = "utf-8"
+        yield from response.iter_lines(decode_unicode=True, chunk_size=65536)
+
+# --- Patterns ---
+# Anchored per line (re.M), so the same pattern serves finditer over a whole
+# body and .match() on a single streamed line. Label blocks are only
+# tokenised for rows that matched.
+LABEL_RE = re.compile(r'(\w+)="([^"]*)"', re.ASCII)
+CADVISOR_RE = re.compile(
+    r'^(container_cpu_usage_seconds_total|container_memory_usage_bytes)\{([^}]*)\}\s+(\S+)', re.M | re.ASCII
+)
+KSM_RE = re.compile(
+    r'^(kube_pod_container_resource_(?:requests|limits)|kube_pod_info|kube_pod_owner)\{([^}]*)\}\s+(\S+)',
+    re.M | re.ASCII,
+)
+KSM_RESOURCE_RE = re.compile(
+    r'^kube_pod_container_resource_(requests|limits)\{([^}]*)\}\s+(\S+)', re.M | re.ASCII
+)
+
+# Only the labels a container key is built from are captured; the rest of
+# the block is skipped inside the regex engine
+CONTAINER_LABEL_RE = re.compile(
+    r'\b(namespace|pod|container|container_label_io_kubernetes_pod_namespace'
+    r'|container_label_io_kubernetes_pod_name|container_label_io_kubernetes_container_name)="([^"]*)"',
+    re.ASCII,
+)
+
+def _find_label(label_part, name, start):
+    # Value of label `name` at or after `start`, plus the offset just past
+    # it. The name must open the block or follow a comma, so pod="..." never
+    # matches inside pod_namespace="...".
+    if start == 0 and label_part.startswith(name + '="'):
+        i = len(name) + 2
+    else:
+        i = label_part.find(',' + name + '="', start)
+        if i < 0:
+            return None, start
+        i += len(name) + 3
+    j = label_part.find('"', i)
+    return label_part[i:j], j + 1
+
+def container_key(label_part):
+    # (namespace, pod, container), falling back to the
+    # container_label_io_kubernetes_* names some cAdvisor builds use.
+    # cAdvisor emits labels sorted, so container < namespace < pod: each
+    # lookup resumes where the previous one ended and three finds cover
+    # the common row. Any other shape takes the generic path below.
+    container, end = _find_label(label_part, "container", 0)
+    if container is not None:
+        ns, end = _find_label(label_part, "namespace", end)
+        if ns is not None:
+            pod, _ = _find_label(label_part, "pod", end)
+            if pod is not None:
+                return ns, pod, container
+    labels = dict(CONTAINER_LABEL_RE.findall(label_part))
+    return (
+        labels.get("namespace", labels.get("container_label_io_kubernetes_pod_namespace", "")),
+        labels.get("pod", labels.get("container_label_io_kubernetes_pod_name", "")),
+        labels.get("container", labels.get("container_label_io_kubernetes_container_name", "")),
+    )
+
+def parse_samples(text):
+    # (metric, container key, value) for every cAdvisor cpu/memory row
+    for m in CADVISOR_RE.finditer(text):
+        name, label_str, val = m.groups()
+        yield name, container_key(label_str), float(val)
+
+def _index_ksm(matches):
+    # Single pass: resource rows fill `data` and a (ns, pod) -> keys index;
+    # pod_info/owner rows are remembered per pod and attached afterwards,
+    # so the result does not depend on metric family order in the body.
+    data = defaultdict(dict)
+    by_pod = defaultdict(list)
+    pod_nodes = {}
+    pod_owners = {}
+    for m in matches:
+        metric, label_part, val = m.groups()
+        labels = dict(LABEL_RE.findall(label_part))
+        ns, pod = labels.get("namespace"), labels.get("pod")
+        if not ns or not pod:
+            continue
+        if metric == "kube_pod_info":
+            if labels.get("node") and float(val) == 1:
+                pod_nodes[(ns, pod)] = labels["node"]
+        elif metric == "kube_pod_owner":
+            if labels.get("owner_kind") and float(val) == 1:
+                pod_owners[(ns, pod)] = labels["owner_kind"]
+        else:
+            container, node, resource = labels.get("container"), labels.get("node"), labels.get("resource")
+            if not container or not node or resource not in ("cpu", "memory"):
+                continue
+            val = float(val)
+            if resource == "memory":
+                val /= 1024 ** 2
+            key = (ns, pod, container)
+            if key not in data:
+                by_pod[(ns, pod)].append(key)
+            data[key][f"{resource}_{metric.rpartition('_')[2]}"] = val
+            data[key]["node"] = node
+    for pod_key, node in pod_nodes.items():
+        for key in by_pod.get(pod_key, ()):
+            data[key].setdefault("node", node)
+    for pod_key, owner_kind in pod_owners.items():
+        for key in by_pod.get(pod_key, ()):
+            data[key]["owner"] = owner_kind
+    return data
+
+def parse_ksm(lines):
+    # {(ns, pod, container): {"cpu_requests", ..., "node", "owner"}} from
+    # streamed kube-state-metrics lines
+    return _index_ksm(m for m in map(KSM_RE.match, lines) if m)
+
+def parse_ksm_text(text):
+    # Same as parse_ksm, scanning an already-read body in one finditer pass
+    return _index_ksm(KSM_RE.finditer(text))
+
+# --- Port-forward helpers ---
+def find_free_ports(n):
+    # Bind all n sockets before closing any, so the kernel hands out n
+    # distinct ports in one pass, then release them together
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(n)]
+    try:
+        for s in socks:
+            s.bind(('', 0))
+        return [s.getsockname()[1] for s in socks]
+    finally:
+        for s in socks:
+            s.close()
+
+async def _wait_for_port(port, timeout):
+    # Retry the connect with exponential backoff (20ms, 40ms, ... capped at
+    # 1s) rather than a fixed 0.5s poll, so a ready port is seen almost at once
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    delay = 0.02
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('localhost', port)
+        except OSError:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1.0)
+            continue
+        # SO_LINGER 0 closes with a reset, so probes leave no TIME_WAIT behind
+        writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        writer.close()
+        return True
+
+def wait_for_ports(pod_ports, timeout=10):
+    # Probe every port concurrently; returns {pod: ready}
+    async def wait_all():
+        return await asyncio.gather(*(_wait_for_port(port, timeout) for port in pod_ports.values()))
+    return dict(zip(pod_ports, asyncio.run(wait_all())))
@@ -2,7 +2,7 @@ from fastapi import FastAPI, Depends, HTTPException, Header, status
 from pydantic import BaseModel
 from jose import JWTError, jwt
 from clickhouse_driver import Client
-import os, time, datetime
+import os, sys, time, functools, hmac
 
 # ------------------------------------------------------------------
 # Environment / secrets
@@ -14,6 +14,7 @@ CLICKHOUSE_HOST   = os.getenv("CLICKHOUSE_HOST", "clickhouse")
 CLICKHOUSE_DB     = os.getenv("CLICKHOUSE_DB", "metrics")
 CLICKHOUSE_USER   = os.getenv("CLICKHOUSE_USER", "default")
 CLICKHOUSE_PASS   = os.getenv("CLICKHOUSE_PASSWORD", "")
+INIT_SCHEMA       = os.getenv("INIT_SCHEMA") == "1"
 
 # ------------------------------------------------------------------
 # ClickHouse connection
@@ -23,20 +24,23 @@ ch = Client(host=CLICKHOUSE_HOST,
             user=CLICKHOUSE_USER,
             password=CLICKHOUSE_PASS)
 
-# Create table if it doesn’t exist
-ch.execute("""
-CREATE TABLE IF NOT EXISTS container_metrics (
-    ts             DateTime,
-    cluster        String,
-    node           String,
-    namespace      String,
-    pod            String,
-    container      String,
-    cpu_usage_sec  Float64,
-    mem_usage_b    UInt64
-) ENGINE = MergeTree()
-ORDER BY (ts, cluster, node, namespace, pod, container)
-""")
+# Create table if it doesn’t exist. Not run at import, so workers and
+# reloads skip the DDL round trip. Run it once per deployment with
+# `python3 python-app.py --init-db` (or INIT_SCHEMA=1 python3 python-app.py).
+def init_schema():
+    ch.execute("""
+    CREATE TABLE IF NOT EXISTS container_metrics (
+        ts             DateTime,
+        cluster        String,
+        node           String,
+        namespace      String,
+        pod            String,
+        container      String,
+        cpu_usage_sec  Float64,
+        mem_usage_b    UInt64
+    ) ENGINE = MergeTree()
+    ORDER BY (ts, cluster, node, namespace, pod, container)
+    """)
 
 # ------------------------------------------------------------------
 # FastAPI setup
@@ -62,20 +66,29 @@ class MetricsPayload(BaseModel):
     records: list[MetricsSample]
 
 # -------------- auth helpers --------------
+@functools.lru_cache(maxsize=1024)
+def _decode(token: str):
+    # Cached per raw token; expiry is re-checked by the caller on every hit
+    payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    return payload.get("sub"), payload.get("exp")  # username, expiry
+
 def verify_jwt_token(token: str):
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload.get("sub")  # username
+        sub, exp = _decode(token)
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Invalid or expired token")
+    if exp is not None and exp <= time.time():
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Invalid or expired token")
+    return sub
 
 def auth_guard(authorization: str = Header(...)):
     scheme, _, token = authorization.partition(" ")
     if scheme.lower() != "bearer":
         raise HTTPException(status_code=401, detail="Bad auth header")
     # Static-token path (optional)
-    if RAW_SHARED_TOKEN and token == RAW_SHARED_TOKEN:
+    if RAW_SHARED_TOKEN and hmac.compare_digest(token.encode(), RAW_SHARED_TOKEN.encode()):
         return "static-client"
     return verify_jwt_token(token)
 
@@ -96,16 +109,29 @@ def authenticate(req: AuthRequest):
 
 @app.post("/ingest")
 def ingest(payload: MetricsPayload, client_id: str = Depends(auth_guard)):
-    # Transform records to ClickHouse rows
-    rows = [
-        (datetime.datetime.fromtimestamp(r.ts),
-         r.cluster, r.node, r.namespace, r.pod, r.container,
-         r.cpu_usage_sec, r.mem_usage_b)
-        for r in payload.records
-    ]
+    # Transform records to ClickHouse columns (native protocol is columnar)
+    ts_col, cluster_col, node_col, ns_col = [], [], [], []
+    pod_col, cont_col, cpu_col, mem_col = [], [], [], []
+    for r in payload.records:
+        ts_col.append(int(r.ts))  # DateTime accepts epoch seconds as-is
+        cluster_col.append(r.cluster)
+        node_col.append(r.node)
+        ns_col.append(r.namespace)
+        pod_col.append(r.pod)
+        cont_col.append(r.container)
+        cpu_col.append(r.cpu_usage_sec)
+        mem_col.append(r.mem_usage_b)
     ch.execute(
-        "INSERT INTO container_metrics VALUES",
-        rows,
-        types_check=True,
+        "INSERT INTO container_metrics "
+        "(ts,cluster,node,namespace,pod,container,cpu_usage_sec,mem_usage_b) VALUES",
+        [ts_col, cluster_col, node_col, ns_col, pod_col, cont_col, cpu_col, mem_col],
+        columnar=True,
     )
-    return {"inserted": len(rows)}
+    return {"inserted": len(ts_col)}
+
+# ------------------------------------------------------------------
+# Schema setup: python3 python-app.py --init-db
+# ------------------------------------------------------------------
+if __name__ == "__main__":
+    if "--init-db" in sys.argv or INIT_SCHEMA:
+        init_schema()
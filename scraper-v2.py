@@ -1,54 +1,29 @@
 import time
-import requests
-import re
+import numpy as np
 from datetime import datetime, timezone
-from collections import defaultdict
-
-# -----------------------------
-# Parse label string
-# -----------------------------
-def parse_labels(label_str):
-    labels = {}
-    for part in label_str.split(','):
-        if '=' in part:
-            k, v = part.split('=', 1)
-            labels[k.strip()] = v.strip('"')
-    return labels
+from metrics_parser import CADVISOR_RE, container_key, iter_metric_lines, parse_ksm
 
 # -----------------------------
 # Use working CPU/MEM logic from your reference
 # -----------------------------
 def fetch_cadvisor_metrics():
-    metrics = requests.get("http://localhost:8081/metrics").text.splitlines()
     usage = {}
     timestamp = time.time()
 
-    for line in metrics:
-        if line.startswith("container_cpu_usage_seconds_total{"):
-            label_part = line.split('{', 1)[1].split('}', 1)[0]
-            labels = parse_labels(label_part)
-            ns = labels.get("namespace", labels.get("container_label_io_kubernetes_pod_namespace", ""))
-            pod = labels.get("pod", labels.get("container_label_io_kubernetes_pod_name", ""))
-            container = labels.get("container", labels.get("container_label_io_kubernetes_container_name", ""))
-            if not container or container in ("POD", ""):
-                continue
-            value = float(line.split()[-2]) if len(line.split()) > 2 else float(line.split()[-1])
-            key = (ns, pod, container)
-            usage[key] = {"cpu": value, "timestamp": timestamp}
-
-        elif line.startswith("container_memory_usage_bytes{"):
-            label_part = line.split('{', 1)[1].split('}', 1)[0]
-            labels = parse_labels(label_part)
-            ns = labels.get("namespace", labels.get("container_label_io_kubernetes_pod_namespace", ""))
-            pod = labels.get("pod", labels.get("container_label_io_kubernetes_pod_name", ""))
-            container = labels.get("container", labels.get("container_label_io_kubernetes_container_name", ""))
-            if not container or container in ("POD", ""):
-                continue
-            value = float(line.split()[-2]) if len(line.split()) > 2 else float(line.split()[-1])
-            key = (ns, pod, container)
-            if key not in usage:
-                usage[key] = {}
-            usage[key]["memory"] = value / (1024 ** 2)  # bytes to MiB
+    for line in iter_metric_lines("http://localhost:8081/metrics", timeout=None):
+        m = CADVISOR_RE.match(line)
+        if not m:
+            continue
+        metric, label_part, value = m.groups()
+        ns, pod, container = container_key(label_part)
+        if not container or container in ("POD", ""):
+            continue
+        entry = usage.setdefault((ns, pod, container), {})
+        if metric == "container_cpu_usage_seconds_total":
+            entry["cpu"] = float(value)
+            entry["timestamp"] = timestamp
+        else:
+            entry["memory"] = float(value) / (1024 ** 2)  # bytes to MiB
 
     return usage
 
@@ -56,47 +31,24 @@ def fetch_cadvisor_metrics():
 # Existing kube-state-metrics parsing
 # -----------------------------
 def fetch_ksm():
-    lines = requests.get("http://localhost:8080/metrics").text.splitlines()
-    data = defaultdict(dict)
-
-    resource_pattern = re.compile(
-        r'kube_pod_container_resource_(requests|limits){.*?namespace="([^"]+)",pod="([^"]+)",.*?container="([^"]+)",.*?node="([^"]+)",.*?resource="(cpu|memory)".*?}\s+([0-9.e+-]+)'
-    )
-    pod_info_pattern = re.compile(
-        r'kube_pod_info{.*?namespace="([^"]+)",pod="([^"]+)",.*?node="([^"]+)".*?}\s+1'
-    )
-    owner_pattern = re.compile(
-        r'kube_pod_owner{[^}]*namespace="([^"]+)",pod="([^"]+)",[^}]*owner_kind="([^"]+)"[^}]*}\s+1'
-    )
+    return parse_ksm(iter_metric_lines("http://localhost:8080/metrics", timeout=None))
 
-    for line in lines:
-        m = resource_pattern.match(line)
-        if m:
-            kind, ns, pod, container, node, resource, val = m.groups()
-            val = float(val)
-            if resource == "memory":
-                val /= 1024 ** 2
-            key = (ns, pod, container)
-            data[key][f"{resource}_{kind}"] = val
-            data[key]["node"] = node
-
-    for line in lines:
-        m = pod_info_pattern.match(line)
-        if m:
-            ns, pod, node = m.groups()
-            for key in data:
-                if key[0] == ns and key[1] == pod and "node" not in data[key]:
-                    data[key]["node"] = node
-
-    for line in lines:
-        m = owner_pattern.match(line)
-        if m:
-            ns, pod, owner_kind = m.groups()
-            for key in data:
-                if key[0] == ns and key[1] == pod:
-                    data[key]["owner"] = owner_kind
-
-    return data
+# -----------------------------
+# Per-container CPU rate between two scrapes
+# -----------------------------
+def cpu_rates(prev_metrics, curr_metrics):
+    # Align the containers seen in both scrapes, then compute every
+    # delta_cpu / delta_time in one vectorised divide
+    keys = [key for key in sorted(curr_metrics)
+            if key in prev_metrics and "cpu" in curr_metrics[key] and "cpu" in prev_metrics[key]]
+    n = len(keys)
+    cpu_prev = np.fromiter((prev_metrics[k]["cpu"] for k in keys), np.float64, n)
+    cpu_curr = np.fromiter((curr_metrics[k]["cpu"] for k in keys), np.float64, n)
+    t_prev = np.fromiter((prev_metrics[k]["timestamp"] for k in keys), np.float64, n)
+    t_curr = np.fromiter((curr_metrics[k]["timestamp"] for k in keys), np.float64, n)
+    dt = t_curr - t_prev
+    rates = np.divide(cpu_curr - cpu_prev, dt, out=np.zeros(n), where=dt > 0)
+    return zip(keys, rates.tolist())
 
 # -----------------------------
 # Loop with correct CPU/MEM logic
@@ -113,14 +65,8 @@ while True:
     print(f"{'Node':<28} {'Namespace':<12} {'Owner':<12} {'Pod':<30} {'Container':<22} {'CPU (cores/sec)':>17} {'MEM (MiB)':>12} {'CPU Req':>8} {'CPU Lim':>8} {'Mem Req':>9} {'Mem Lim':>9}")
     print("-" * 185)
 
-    for key in sorted(curr_metrics):
-        if key not in prev_metrics or "cpu" not in curr_metrics[key] or "cpu" not in prev_metrics[key]:
-            continue
-
+    for key, cpu in cpu_rates(prev_metrics, curr_metrics):
         ns, pod, container = key
-        delta_cpu = curr_metrics[key]["cpu"] - prev_metrics[key]["cpu"]
-        delta_time = curr_metrics[key]["timestamp"] - prev_metrics[key]["timestamp"]
-        cpu = delta_cpu / delta_time if delta_time > 0 else 0.0
         mem = curr_metrics[key].get("memory", 0.0)
 
         ksm = ksm_metrics.get(key, {})
@@ -1,41 +1,39 @@
+import os
+import sys
 import subprocess
 import time
-import socket
-import requests
-import re
+import asyncio
+import aiohttp
+import orjson
 from datetime import datetime, timezone
-from collections import defaultdict
+from operator import itemgetter
 from kubernetes import client, config
+from metrics_parser import parse_samples, find_free_ports, wait_for_ports, parse_ksm_text
 
-# ------------ Helper to parse labels -------------
-def parse_labels(label_str):
-    labels = {}
-    for part in label_str.split(','):
-        if '=' in part:
-            k, v = part.split('=', 1)
-            labels[k.strip()] = v.strip('"')
-    return labels
-
-# ------------ Find free TCP port on localhost -------------
-def find_free_port():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind(('', 0))
-        return s.getsockname()[1]
+# ------------ In-cluster vs. port-forward -------------
+# Inside the cluster pod IPs and Service DNS are routable, so cAdvisor and
+# KSM are scraped directly; from a workstation we fall back to kubectl
+# port-forward tunnels.
+IN_CLUSTER = "KUBERNETES_SERVICE_HOST" in os.environ
+KSM_URL = os.getenv("KSM_URL", "http://kube-state-metrics.kube-system.svc:8080/metrics"
+                    if IN_CLUSTER else "http://localhost:8080/metrics")
 
 # ------------ Get running cAdvisor pods -------------
 def get_running_cadvisor_pods(namespace='kube-system', label_selector='app=cadvisor'):
-    config.load_kube_config()
+    if IN_CLUSTER:
+        config.load_incluster_config()
+    else:
+        config.load_kube_config()
     v1 = client.CoreV1Api()
     pods = v1.list_namespaced_pod(namespace=namespace, label_selector=label_selector)
-    return [pod.metadata.name for pod in pods.items if pod.status.phase == 'Running']
+    return {pod.metadata.name: pod.status.pod_ip for pod in pods.items if pod.status.phase == 'Running'}
 
 # ------------ Assign ports to pods in a grid -------------
 def assign_ports_to_pods(pod_names, columns=5):
     assigned = {}
     row = 0
     col = 0
-    for pod in pod_names:
-        port = find_free_port()
+    for pod, port in zip(pod_names, find_free_ports(len(pod_names))):
         assigned[pod] = {'port': port, 'row': row, 'column': col}
         col += 1
         if col >= columns:
@@ -59,53 +57,39 @@ def start_port_forwards(namespace, assignments):
         procs.append((pod, proc))
     return procs
 
-# ------------ Wait for a port to be open -------------
-def wait_for_port(port, timeout=10):
-    start = time.time()
-    while time.time() - start < timeout:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            result = sock.connect_ex(('localhost', port))
-            if result == 0:
-                return True
-        time.sleep(0.5)
-    return False
+# ------------ Shared HTTP fetch -------------
+FETCH_TIMEOUT = aiohttp.ClientTimeout(total=5)
+
+def new_session():
+    # One session for the life of the scraper so keep-alive connections
+    # survive between scrape cycles; limit=0 lets every pod fetch run at once
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, keepalive_timeout=60))
+
+async def fetch_text(session, url, timeout=FETCH_TIMEOUT):
+    async with session.get(url, timeout=timeout) as resp:
+        return await resp.text()
 
 # ------------ Fetch metrics from all port-forwarded pods -------------
-def fetch_cadvisor_metrics_multiple(pod_ports):
+async def fetch_cadvisor_metrics_multiple(session, pod_urls):
     usage = {}
     timestamp = time.time()
 
-    for pod, port in pod_ports.items():
-        try:
-            url = f"http://localhost:{port}/metrics"
-            metrics = requests.get(url, timeout=5).text.splitlines()
-        except Exception as e:
-            print(f"Error fetching metrics from pod {pod} at port {port}: {e}")
-            continue
+    pods = list(pod_urls)
+    bodies = await asyncio.gather(
+        *(fetch_text(session, pod_urls[pod]) for pod in pods),
+        return_exceptions=True,
+    )
 
-        for line in metrics:
-            if line.startswith("container_cpu_usage_seconds_total{"):
-                label_part = line.split('{', 1)[1].split('}', 1)[0]
-                labels = parse_labels(label_part)
-                ns = labels.get("namespace", labels.get("container_label_io_kubernetes_pod_namespace", ""))
-                pod_name = labels.get("pod", labels.get("container_label_io_kubernetes_pod_name", ""))
-                container = labels.get("container", labels.get("container_label_io_kubernetes_container_name", ""))
-                if not container or container in ("POD", ""):
-                    continue
-                value = float(line.split()[-2]) if len(line.split()) > 2 else float(line.split()[-1])
-                key = (ns, pod_name, container)
+    for pod, body in zip(pods, bodies):
+        if isinstance(body, Exception):
+            print(f"Error fetching metrics from pod {pod} at {pod_urls[pod]}: {body}")
+            continue
+        for name, key, value in parse_samples(body):
+            if key[2] in ("POD", ""):
+                continue
+            if name == "container_cpu_usage_seconds_total":
                 usage[key] = {"cpu": value, "timestamp": timestamp}
-
-            elif line.startswith("container_memory_usage_bytes{"):
-                label_part = line.split('{', 1)[1].split('}', 1)[0]
-                labels = parse_labels(label_part)
-                ns = labels.get("namespace", labels.get("container_label_io_kubernetes_pod_namespace", ""))
-                pod_name = labels.get("pod", labels.get("container_label_io_kubernetes_pod_name", ""))
-                container = labels.get("container", labels.get("container_label_io_kubernetes_container_name", ""))
-                if not container or container in ("POD", ""):
-                    continue
-                value = float(line.split()[-2]) if len(line.split()) > 2 else float(line.split()[-1])
-                key = (ns, pod_name, container)
+            else:
                 if key not in usage:
                     usage[key] = {}
                 usage[key]["memory"] = value / (1024 ** 2)  # bytes to MiB
@@ -113,101 +97,113 @@ def fetch_cadvisor_metrics_multiple(pod_ports):
     return usage
 
 # ------------ Your existing kube-state-metrics parsing -------------
-def fetch_ksm():
-    lines = requests.get("http://localhost:8080/metrics").text.splitlines()
-    data = defaultdict(dict)
+# parse_ksm_text runs KSM_RE over the whole body with finditer; label
+# blocks are only tokenised for rows that matched.
+async def fetch_ksm(session):
+    return parse_ksm_text(await fetch_text(session, KSM_URL, timeout=None))
+
+# ------------ KSM cache -------------
+# Requests/limits/owners move on a minutes scale, so the KSM download and
+# parse is reused between scrapes and only redone once older than the TTL
+KSM_TTL = 300
+
+class KSMCache:
+    def __init__(self, ttl=KSM_TTL):
+        self.ttl = ttl
+        self.value = None
+        self.fetched_at = 0.0
+
+    async def get(self, session):
+        now = time.monotonic()
+        if self.value is None or now - self.fetched_at >= self.ttl:
+            self.value = await fetch_ksm(session)
+            self.fetched_at = now
+        return self.value
+
+# ------------ Output -------------
+TTY = sys.stdout.isatty()
+EMPTY = {}
+TABLE_HEADER = (
+    "\n📊 [{now}] LIVE RESOURCE USAGE\n"
+    f"{'Node':<28} {'Namespace':<12} {'Owner':<12} {'Pod':<30} {'Container':<22} {'CPU (cores/sec)':>17} {'MEM (MiB)':>12} {'CPU Req':>8} {'CPU Lim':>8} {'Mem Req':>9} {'Mem Lim':>9}\n"
+    + "-" * 185 + "\n"
+)
+
+def format_row(key, cpu, mem, ksm):
+    ns, pod, container = key
+    node = ksm.get("node", "unknown")
+    owner = ksm.get("owner", "unknown")
+    cpu_req = ksm.get("cpu_requests", 0.0)
+    cpu_lim = ksm.get("cpu_limits", 0.0)
+    mem_req = ksm.get("memory_requests", 0.0)
+    mem_lim = ksm.get("memory_limits", 0.0)
+    return f"{node:<28} {ns:<12} {owner:<12} {pod:<30} {container:<22} {cpu:>17.4f} {mem:>12.2f} {cpu_req:>8.2f} {cpu_lim:>8.2f} {mem_req:>9.2f} {mem_lim:>9.2f}\n"
+
+def json_row(now, key, cpu, mem, ksm):
+    ns, pod, container = key
+    return orjson.dumps({
+        "timestamp": now, "namespace": ns, "pod": pod, "container": container,
+        "cpu": cpu, "memory": mem, **ksm,
+    }, option=orjson.OPT_APPEND_NEWLINE).decode()
+
+# ------------ Scrape loop -------------
+async def scrape_loop(pod_urls):
+    ksm_cache = KSMCache()
+    async with new_session() as session:
+        prev_metrics = await fetch_cadvisor_metrics_multiple(session, pod_urls)
+        await asyncio.sleep(30)
 
-    resource_pattern = re.compile(
-        r'kube_pod_container_resource_(requests|limits){.*?namespace="([^"]+)",pod="([^"]+)",.*?container="([^"]+)",.*?node="([^"]+)",.*?resource="(cpu|memory)".*?}\s+([0-9.e+-]+)'
-    )
-    pod_info_pattern = re.compile(
-        r'kube_pod_info{.*?namespace="([^"]+)",pod="([^"]+)",.*?node="([^"]+)".*?}\s+1'
-    )
-    owner_pattern = re.compile(
-        r'kube_pod_owner{[^}]*namespace="([^"]+)",pod="([^"]+)",[^}]*owner_kind="([^"]+)"[^}]*}\s+1'
-    )
+        while True:
+            curr_metrics, ksm_metrics = await asyncio.gather(
+                fetch_cadvisor_metrics_multiple(session, pod_urls),
+                ksm_cache.get(session),
+            )
+            now = datetime.now(timezone.utc).isoformat()
+
+            rows = []
+            for key, curr in curr_metrics.items():
+                prev = prev_metrics.get(key)
+                if prev is None or "cpu" not in curr or "cpu" not in prev:
+                    continue
+                delta_time = curr["timestamp"] - prev["timestamp"]
+                cpu = (curr["cpu"] - prev["cpu"]) / delta_time if delta_time > 0 else 0.0
+                rows.append((key, cpu, curr.get("memory", 0.0), ksm_metrics.get(key, EMPTY)))
+
+            # The sorted table is for a human at a terminal; anything else
+            # (container logs, a pipe) gets one compact JSON object per row,
+            # unsorted. Either way the cycle is a single writelines call.
+            if TTY:
+                rows.sort(key=itemgetter(0))
+                sys.stdout.writelines([TABLE_HEADER.format(now=now)] + [format_row(*row) for row in rows])
+            else:
+                sys.stdout.writelines([json_row(now, *row) for row in rows])
+            sys.stdout.flush()
 
-    for line in lines:
-        m = resource_pattern.match(line)
-        if m:
-            kind, ns, pod, container, node, resource, val = m.groups()
-            val = float(val)
-            if resource == "memory":
-                val /= 1024 ** 2
-            key = (ns, pod, container)
-            data[key][f"{resource}_{kind}"] = val
-            data[key]["node"] = node
-
-    for line in lines:
-        m = pod_info_pattern.match(line)
-        if m:
-            ns, pod, node = m.groups()
-            for key in data:
-                if key[0] == ns and key[1] == pod and "node" not in data[key]:
-                    data[key]["node"] = node
-
-    for line in lines:
-        m = owner_pattern.match(line)
-        if m:
-            ns, pod, owner_kind = m.groups()
-            for key in data:
-                if key[0] == ns and key[1] == pod:
-                    data[key]["owner"] = owner_kind
-
-    return data
+            prev_metrics = curr_metrics
+            await asyncio.sleep(30)
 
 # ------------ Main loop -------------
 if __name__ == '__main__':
     namespace = 'kube-system'
 
     pods = get_running_cadvisor_pods(namespace)
-    assignments = assign_ports_to_pods(pods, columns=3)
-    procs = start_port_forwards(namespace, assignments)
+    if IN_CLUSTER:
+        procs = []
+        pod_urls = {pod: f"http://{ip}:8080/metrics" for pod, ip in pods.items()}
+    else:
+        assignments = assign_ports_to_pods(pods, columns=3)
+        procs = start_port_forwards(namespace, assignments)
 
-    pod_ports = {pod: info['port'] for pod, info in assignments.items()}
+        pod_ports = {pod: info['port'] for pod, info in assignments.items()}
+        pod_urls = {pod: f"http://localhost:{port}/metrics" for pod, port in pod_ports.items()}
 
-    # Wait for all port-forwarded ports to be ready before scraping
-    for pod, port in pod_ports.items():
-        ready = wait_for_port(port, timeout=15)
-        if not ready:
-            print(f"Warning: Port {port} for pod {pod} did not become ready in time")
-
-    prev_metrics = fetch_cadvisor_metrics_multiple(pod_ports)
-    time.sleep(30)
+        # Wait for all port-forwarded ports to be ready before scraping
+        for pod, ready in wait_for_ports(pod_ports, timeout=15).items():
+            if not ready:
+                print(f"Warning: Port {pod_ports[pod]} for pod {pod} did not become ready in time")
 
     try:
-        while True:
-            curr_metrics = fetch_cadvisor_metrics_multiple(pod_ports)
-            ksm_metrics = fetch_ksm()
-            now = datetime.now(timezone.utc).isoformat()
-
-            print(f"\n📊 [{now}] LIVE RESOURCE USAGE")
-            print(f"{'Node':<28} {'Namespace':<12} {'Owner':<12} {'Pod':<30} {'Container':<22} {'CPU (cores/sec)':>17} {'MEM (MiB)':>12} {'CPU Req':>8} {'CPU Lim':>8} {'Mem Req':>9} {'Mem Lim':>9}")
-            print("-" * 185)
-
-            for key in sorted(curr_metrics):
-                if key not in prev_metrics or "cpu" not in curr_metrics[key] or "cpu" not in prev_metrics[key]:
-                    continue
-
-                ns, pod, container = key
-                delta_cpu = curr_metrics[key]["cpu"] - prev_metrics[key]["cpu"]
-                delta_time = curr_metrics[key]["timestamp"] - prev_metrics[key]["timestamp"]
-                cpu = delta_cpu / delta_time if delta_time > 0 else 0.0
-                mem = curr_metrics[key].get("memory", 0.0)
-
-                ksm = ksm_metrics.get(key, {})
-                node = ksm.get("node", "unknown")
-                owner = ksm.get("owner", "unknown")
-                cpu_req = ksm.get("cpu_requests", 0.0)
-                cpu_lim = ksm.get("cpu_limits", 0.0)
-                mem_req = ksm.get("memory_requests", 0.0)
-                mem_lim = ksm.get("memory_limits", 0.0)
-
-                print(f"{node:<28} {ns:<12} {owner:<12} {pod:<30} {container:<22} {cpu:>17.4f} {mem:>12.2f} {cpu_req:>8.2f} {cpu_lim:>8.2f} {mem_req:>9.2f} {mem_lim:>9.2f}")
-
-            prev_metrics = curr_metrics
-            time.sleep(30)
-
+        asyncio.run(scrape_loop(pod_urls))
     except KeyboardInterrupt:
         print("Stopping port-forwards...")
         for pod, proc in procs:
@@ -2,12 +2,11 @@ import os
 import subprocess
 import sys
 import time
-import socket
 import requests
-import re
+import orjson
 from datetime import datetime, timezone
-from collections import defaultdict
 from kubernetes import client, config
+from metrics_parser import SESSION, container_key, iter_metric_lines, find_free_ports, wait_for_ports, parse_ksm
 
 # ---------- Setup Cronjob (Optional) ----------
 def setup_cron():
@@ -37,26 +36,13 @@ INGEST_URL = "http://localhost:8082/ingest"
 def get_jwt_token():
     auth_payload = {"username": USERNAME, "password": PASSWORD}
     headers = {"Content-Type": "application/json"}
-    response = requests.post(AUTH_URL, json=auth_payload, headers=headers)
+    response = SESSION.post(AUTH_URL, data=orjson.dumps(auth_payload), headers=headers)
     if response.status_code != 200:
         raise Exception(f"Auth failed: {response.text}")
-    token = response.json().get("access_token")
+    token = orjson.loads(response.content).get("access_token")
     return token
 
 # ---------- Helpers ----------
-def parse_labels(label_str):
-    labels = {}
-    for part in label_str.split(','):
-        if '=' in part:
-            k, v = part.split('=', 1)
-            labels[k.strip()] = v.strip('"')
-    return labels
-
-def find_free_port():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind(('', 0))
-        return s.getsockname()[1]
-
 def get_running_cadvisor_pods(namespace='kube-system', label_selector='app=cadvisor'):
     config.load_kube_config()
     v1 = client.CoreV1Api()
@@ -67,8 +53,7 @@ def assign_ports_to_pods(pod_names, columns=5):
     assigned = {}
     row = 0
     col = 0
-    for pod in pod_names:
-        port = find_free_port()
+    for pod, port in zip(pod_names, find_free_ports(len(pod_names))):
         assigned[pod] = {'port': port, 'row': row, 'column': col}
         col += 1
         if col >= columns:
@@ -90,91 +75,44 @@ def start_port_forwards(namespace, assignments):
         procs.append((pod, proc))
     return procs
 
-def wait_for_port(port, timeout=10):
-    start = time.time()
-    while time.time() - start < timeout:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            result = sock.connect_ex(('localhost', port))
-            if result == 0:
-                return True
-        time.sleep(0.5)
-    return False
+CADVISOR_PREFIXES = ("container_cpu_usage_seconds_total{", "container_memory_usage_bytes{")
+
+def fetch_pod_usage(url, timestamp):
+    # Parse one pod into its own dict, so a body that fails mid-stream
+    # contributes nothing rather than a partial set of rows
+    usage = {}
+    for line in iter_metric_lines(url):
+        # Both families share one label schema: screen with a single
+        # startswith, parse the key once, then branch on the family
+        if not line.startswith(CADVISOR_PREFIXES):
+            continue
+        label_part = line.split('{', 1)[1].split('}', 1)[0]
+        ns, pod_name, container = container_key(label_part)
+        if not container or container in ("POD", ""):
+            continue
+        value = float(line.rpartition("}")[2].split()[0])  # "<value> [timestamp]"
+        key = (ns, pod_name, container)
+        if line.startswith(CADVISOR_PREFIXES[0]):
+            usage[key] = {"cpu": value, "timestamp": timestamp}
+        else:
+            if key not in usage:
+                usage[key] = {}
+            usage[key]["memory"] = value / (1024 ** 2)
+    return usage
 
 def fetch_cadvisor_metrics_multiple(pod_ports):
     usage = {}
     timestamp = time.time()
     for pod, port in pod_ports.items():
+        # Only network failures skip a pod; parse errors are not swallowed
         try:
-            url = f"http://localhost:{port}/metrics"
-            metrics = requests.get(url, timeout=5).text.splitlines()
-        except Exception:
-            continue
-
-        for line in metrics:
-            if line.startswith("container_cpu_usage_seconds_total{"):
-                label_part = line.split('{', 1)[1].split('}', 1)[0]
-                labels = parse_labels(label_part)
-                ns = labels.get("namespace", labels.get("container_label_io_kubernetes_pod_namespace", ""))
-                pod_name = labels.get("pod", labels.get("container_label_io_kubernetes_pod_name", ""))
-                container = labels.get("container", labels.get("container_label_io_kubernetes_container_name", ""))
-                if not container or container in ("POD", ""):
-                    continue
-                value = float(line.split()[-2]) if len(line.split()) > 2 else float(line.split()[-1])
-                key = (ns, pod_name, container)
-                usage[key] = {"cpu": value, "timestamp": timestamp}
-
-            elif line.startswith("container_memory_usage_bytes{"):
-                label_part = line.split('{', 1)[1].split('}', 1)[0]
-                labels = parse_labels(label_part)
-                ns = labels.get("namespace", labels.get("container_label_io_kubernetes_pod_namespace", ""))
-                pod_name = labels.get("pod", labels.get("container_label_io_kubernetes_pod_name", ""))
-                container = labels.get("container", labels.get("container_label_io_kubernetes_container_name", ""))
-                if not container or container in ("POD", ""):
-                    continue
-                value = float(line.split()[-2]) if len(line.split()) > 2 else float(line.split()[-1])
-                key = (ns, pod_name, container)
-                if key not in usage:
-                    usage[key] = {}
-                usage[key]["memory"] = value / (1024 ** 2)
+            usage.update(fetch_pod_usage(f"http://localhost:{port}/metrics", timestamp))
+        except requests.RequestException as e:
+            print(f"Skipping cAdvisor pod {pod}: {e}")
     return usage
 
 def fetch_ksm():
-    lines = requests.get("http://localhost:8080/metrics").text.splitlines()
-    data = defaultdict(dict)
-    resource_pattern = re.compile(
-        r'kube_pod_container_resource_(requests|limits){.*?namespace="([^"]+)",pod="([^"]+)",.*?container="([^"]+)",.*?node="([^"]+)",.*?resource="(cpu|memory)".*?}\s+([0-9.e+-]+)'
-    )
-    pod_info_pattern = re.compile(
-        r'kube_pod_info{.*?namespace="([^"]+)",pod="([^"]+)",.*?node="([^"]+)".*?}\s+1'
-    )
-    owner_pattern = re.compile(
-        r'kube_pod_owner{[^}]*namespace="([^"]+)",pod="([^"]+)",[^}]*owner_kind="([^"]+)"[^}]*}\s+1'
-    )
-    for line in lines:
-        m = resource_pattern.match(line)
-        if m:
-            kind, ns, pod, container, node, resource, val = m.groups()
-            val = float(val)
-            if resource == "memory":
-                val /= 1024 ** 2
-            key = (ns, pod, container)
-            data[key][f"{resource}_{kind}"] = val
-            data[key]["node"] = node
-    for line in lines:
-        m = pod_info_pattern.match(line)
-        if m:
-            ns, pod, node = m.groups()
-            for key in data:
-                if key[0] == ns and key[1] == pod and "node" not in data[key]:
-                    data[key]["node"] = node
-    for line in lines:
-        m = owner_pattern.match(line)
-        if m:
-            ns, pod, owner_kind = m.groups()
-            for key in data:
-                if key[0] == ns and key[1] == pod:
-                    data[key]["owner"] = owner_kind
-    return data
+    return parse_ksm(iter_metric_lines("http://localhost:8080/metrics", timeout=None))
 
 def send_to_ingest(token, rows):
     headers = {
@@ -182,11 +120,11 @@ def send_to_ingest(token, rows):
         "Content-Type": "application/json"
     }
     payload = {"records": rows}
-    response = requests.post(INGEST_URL, json=payload, headers=headers)
+    response = SESSION.post(INGEST_URL, data=orjson.dumps(payload), headers=headers)
     if response.status_code != 200:
         print(f"Error ingesting data: {response.text}")
     else:
-        print(f"✅ Data sent successfully: {response.json()}")
+        print(f"✅ Data sent successfully: {orjson.loads(response.content)}")
 
 # ---------- Main Execution ----------
 if __name__ == '__main__':
@@ -197,8 +135,7 @@ if __name__ == '__main__':
     procs = start_port_forwards(namespace, assignments)
     pod_ports = {pod: info['port'] for pod, info in assignments.items()}
 
-    for pod, port in pod_ports.items():
-        wait_for_port(port, timeout=15)
+    wait_for_ports(pod_ports, timeout=15)
 
     prev_metrics = fetch_cadvisor_metrics_multiple(pod_ports)
     time.sleep(30)
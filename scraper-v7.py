@@ -2,12 +2,11 @@ import os
 import subprocess
 import sys
 import time
-import socket
-import requests
-import re
+import orjson
 from datetime import datetime, timezone
 from collections import defaultdict
 from kubernetes import client, config
+from metrics_parser import SESSION, LABEL_RE, CADVISOR_RE, KSM_RESOURCE_RE, container_key, iter_metric_lines, find_free_ports, wait_for_ports
 
 # ---------- Setup Cronjob (Optional) ----------
 def setup_cron():
@@ -35,36 +34,33 @@ INGEST_URL = os.getenv("INGEST_URL", "http://localhost:8082/ingest")
 def get_jwt_token():
     auth_payload = {"username": USERNAME, "password": PASSWORD}
     headers = {"Content-Type": "application/json"}
-    response = requests.post(AUTH_URL, json=auth_payload, headers=headers)
+    response = SESSION.post(AUTH_URL, data=orjson.dumps(auth_payload), headers=headers)
     if response.status_code != 200:
         raise Exception(f"Auth failed: {response.text}")
-    return response.json().get("access_token")
+    return orjson.loads(response.content).get("access_token")
 
-# ---------- Helpers ----------
-def parse_labels(label_str):
-    labels = {}
-    for part in label_str.split(','):
-        if '=' in part:
-            k, v = part.split('=', 1)
-            labels[k.strip()] = v.strip('"')
-    return labels
-
-def find_free_port():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind(('', 0))
-        return s.getsockname()[1]
+# ---------- In-cluster vs. port-forward ----------
+# Inside the cluster pod IPs and Service DNS are routable, so cAdvisor and
+# KSM are scraped directly; from a workstation we fall back to kubectl
+# port-forward tunnels.
+IN_CLUSTER = "KUBERNETES_SERVICE_HOST" in os.environ
+KSM_URL = os.getenv("KSM_URL", "http://kube-state-metrics.kube-system.svc:8080/metrics"
+                    if IN_CLUSTER else "http://localhost:8080/metrics")
 
+# ---------- Helpers ----------
 def get_running_cadvisor_pods(namespace='kube-system', label_selector='app=cadvisor'):
-    config.load_kube_config()
+    if IN_CLUSTER:
+        config.load_incluster_config()
+    else:
+        config.load_kube_config()
     v1 = client.CoreV1Api()
     pods = v1.list_namespaced_pod(namespace=namespace, label_selector=label_selector)
-    return [pod.metadata.name for pod in pods.items if pod.status.phase == 'Running']
+    return {pod.metadata.name: pod.status.pod_ip for pod in pods.items if pod.status.phase == 'Running'}
 
 def assign_ports_to_pods(pod_names, columns=3):
     assigned = {}
     row, col = 0, 0
-    for pod in pod_names:
-        port = find_free_port()
+    for pod, port in zip(pod_names, find_free_ports(len(pod_names))):
         assigned[pod] = {'port': port, 'row': row, 'column': col}
         col += 1
         if col >= columns:
@@ -78,33 +74,24 @@ def start_port_forwards(namespace, assignments):
         procs.append((pod, subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)))
     return procs
 
-def wait_for_port(port, timeout=10):
-    start = time.time()
-    while time.time() - start < timeout:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            if s.connect_ex(('localhost', port)) == 0:
-                return True
-        time.sleep(0.5)
-    return False
-
-def fetch_metrics(url):
-    return requests.get(url).text.splitlines()
+# Only request/limit rows are worth a regex, so KSM lines are screened by
+# prefix first and one pattern covers all four series
+KSM_RESOURCE_PREFIXES = ("kube_pod_container_resource_requests{", "kube_pod_container_resource_limits{")
 
 # ---------- Main Execution ----------
 if __name__ == '__main__':
     token = get_jwt_token()
     namespace = 'kube-system'
     pods = get_running_cadvisor_pods(namespace)
-    assignments = assign_ports_to_pods(pods)
-    procs = start_port_forwards(namespace, assignments)
-    pod_ports = {pod: info['port'] for pod, info in assignments.items()}
-    for pod, port in pod_ports.items():
-        wait_for_port(port)
-
-    prev_metrics = fetch_metrics(f"http://localhost:{list(pod_ports.values())[0]}/metrics")
-    time.sleep(30)
-    curr_metrics = fetch_metrics(f"http://localhost:{list(pod_ports.values())[0]}/metrics")
-    ksm_metrics = fetch_metrics("http://localhost:8080/metrics")
+    if IN_CLUSTER:
+        procs = []
+        pod_urls = [f"http://{ip}:8080/metrics" for ip in pods.values()]
+    else:
+        assignments = assign_ports_to_pods(pods)
+        procs = start_port_forwards(namespace, assignments)
+        pod_ports = {pod: info['port'] for pod, info in assignments.items()}
+        wait_for_ports(pod_ports)
+        pod_urls = [f"http://localhost:{port}/metrics" for port in pod_ports.values()]
 
     # Collect Kubernetes info
     v1 = client.CoreV1Api()
@@ -119,28 +106,31 @@ if __name__ == '__main__':
             container_info[(ns, name)].append(c.name)
 
     # Parse KSM data
-    resource_data, container_usage = defaultdict(lambda: defaultdict(dict)), defaultdict(dict)
-    patterns = {
-        'memory_request': re.compile(r'kube_pod_container_resource_requests{.*namespace="([^"]+)",.*pod="([^"]+)",.*resource="memory".*}\s+([0-9.e+-]+)'),
-        'memory_limit': re.compile(r'kube_pod_container_resource_limits{.*namespace="([^"]+)",.*pod="([^"]+)",.*resource="memory".*}\s+([0-9.e+-]+)'),
-        'cpu_request': re.compile(r'kube_pod_container_resource_requests{.*namespace="([^"]+)",.*pod="([^"]+)",.*resource="cpu".*}\s+([0-9.e+-]+)'),
-        'cpu_limit': re.compile(r'kube_pod_container_resource_limits{.*namespace="([^"]+)",.*pod="([^"]+)",.*resource="cpu".*}\s+([0-9.e+-]+)')
-    }
-    for line in ksm_metrics:
-        for key, pattern in patterns.items():
-            match = pattern.search(line)
-            if match:
-                ns, pod, val = match.groups()
-                resource_data[ns][pod][key] = float(val)
-
-    cadvisor_cpu = re.compile(r'container_cpu_usage_seconds_total{.*namespace="([^"]+)",.*pod="([^"]+)",.*container="([^"]+)".*}\s+([0-9.e+-]+)')
-    cadvisor_mem = re.compile(r'container_memory_usage_bytes{.*namespace="([^"]+)",.*pod="([^"]+)",.*container="([^"]+)".*}\s+([0-9.e+-]+)')
-    for line in curr_metrics:
-        if (match := cadvisor_cpu.search(line)):
-            ns, pod, container, val = match.groups()
+    resource_data, container_usage = {}, defaultdict(dict)  # resource_data: (ns, pod) -> {metric_key: value}
+    for line in iter_metric_lines(KSM_URL, timeout=None):
+        if not line.startswith(KSM_RESOURCE_PREFIXES):
+            continue
+        match = KSM_RESOURCE_RE.match(line)
+        if not match:
+            continue
+        kind, label_part, val = match.groups()
+        labels = dict(LABEL_RE.findall(label_part))
+        ns, pod, resource = labels.get("namespace"), labels.get("pod"), labels.get("resource")
+        if not ns or not pod or resource not in ("cpu", "memory"):
+            continue
+        resource_data.setdefault((ns, pod), {})[f"{resource}_{kind[:-1]}"] = float(val)  # e.g. memory_request
+
+    for line in iter_metric_lines(pod_urls[0], timeout=None):
+        match = CADVISOR_RE.match(line)
+        if not match:
+            continue
+        metric, label_part, val = match.groups()
+        ns, pod, container = container_key(label_part)
+        if not ns or not pod or not container:
+            continue
+        if metric == "container_cpu_usage_seconds_total":
             container_usage[(ns, pod, container)]["cpu"] = float(val)
-        if (match := cadvisor_mem.search(line)):
-            ns, pod, container, val = match.groups()
+        else:
             container_usage[(ns, pod, container)]["memory"] = float(val) / (1024 ** 2)
 
     # Prepare rows
@@ -167,8 +157,8 @@ if __name__ == '__main__':
 
     # Send to ingest
     if rows:
-        response = requests.post(INGEST_URL, json={"records": rows}, headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"})
-        print(f"✅ Data sent: {response.json() if response.ok else response.text}")
+        response = SESSION.post(INGEST_URL, data=orjson.dumps({"records": rows}), headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"})
+        print(f"✅ Data sent: {orjson.loads(response.content) if response.ok else response.text}")
     else:
         print("No data to send.")
 
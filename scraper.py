@@ -1,47 +1,25 @@
 import time
-import re
-import requests
-import json
+import threading
+import orjson
+import numpy as np
 from datetime import datetime, timezone
 from collections import defaultdict
-from kubernetes import client, config
+from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
+from metrics_parser import SESSION, LABEL_RE, KSM_RESOURCE_RE, parse_samples
 
 # --- Helpers ---
-def parse_labels(label_str):
-    labels = {}
-    for part in label_str.split(','):
-        if '=' in part:
-            k, v = part.split('=', 1)
-            labels[k.strip()] = v.strip('"')
-    return labels
-
 def fetch_cadvisor_metrics():
-    metrics = requests.get("http://localhost:8081/metrics").text.splitlines()
+    text = SESSION.get("http://localhost:8081/metrics").text
     usage = {}
     timestamp = time.time()
 
-    for line in metrics:
-        if line.startswith("container_cpu_usage_seconds_total{"):
-            label_part = line.split('{', 1)[1].split('}', 1)[0]
-            labels = parse_labels(label_part)
-            ns = labels.get("namespace", labels.get("container_label_io_kubernetes_pod_namespace", ""))
-            pod = labels.get("pod", labels.get("container_label_io_kubernetes_pod_name", ""))
-            container = labels.get("container", labels.get("container_label_io_kubernetes_container_name", ""))
-            if not container or container in ("POD", ""):
-                continue
-            value = float(line.split()[-1])
-            usage[(ns, pod, container)] = {"cpu": value, "timestamp": timestamp}
-
-        elif line.startswith("container_memory_usage_bytes{"):
-            label_part = line.split('{', 1)[1].split('}', 1)[0]
-            labels = parse_labels(label_part)
-            ns = labels.get("namespace", labels.get("container_label_io_kubernetes_pod_namespace", ""))
-            pod = labels.get("pod", labels.get("container_label_io_kubernetes_pod_name", ""))
-            container = labels.get("container", labels.get("container_label_io_kubernetes_container_name", ""))
-            if not container or container in ("POD", ""):
-                continue
-            value = float(line.split()[-1])
-            key = (ns, pod, container)
+    for name, key, value in parse_samples(text):
+        if key[2] in ("POD", ""):
+            continue
+        if name == "container_cpu_usage_seconds_total":
+            usage[key] = {"cpu": value, "timestamp": timestamp}
+        else:
             if key not in usage:
                 usage[key] = {}
             usage[key]["memory"] = value / (1024 ** 2)  # MiB
@@ -49,32 +27,147 @@ def fetch_cadvisor_metrics():
     return usage
 
 def fetch_ksm_metrics():
-    return requests.get("http://localhost:8080/metrics").text.splitlines()
+    return SESSION.get("http://localhost:8080/metrics").text
 
-def parse_ksm_metrics(ksm_lines):
-    resource_data = defaultdict(lambda: defaultdict(dict))
+def parse_ksm_metrics(ksm_text):
+    resource_data = {}  # (ns, pod) -> {metric_key: value}
     node_totals = defaultdict(lambda: {'memory_request': 0, 'memory_limit': 0, 'cpu_request': 0, 'cpu_limit': 0})
 
-    patterns = {
-        'memory_request': re.compile(r'kube_pod_container_resource_requests{[^}]*namespace="([^"]+)",[^}]*pod="([^"]+)",[^}]*node="([^"]+)",[^}]*resource="memory"[^}]*}\s+([0-9.e+-]+)'),
-        'memory_limit': re.compile(r'kube_pod_container_resource_limits{[^}]*namespace="([^"]+)",[^}]*pod="([^"]+)",[^}]*node="([^"]+)",[^}]*resource="memory"[^}]*}\s+([0-9.e+-]+)'),
-        'cpu_request': re.compile(r'kube_pod_container_resource_requests{[^}]*namespace="([^"]+)",[^}]*pod="([^"]+)",[^}]*node="([^"]+)",[^}]*resource="cpu"[^}]*}\s+([0-9.e+-]+)'),
-        'cpu_limit': re.compile(r'kube_pod_container_resource_limits{[^}]*namespace="([^"]+)",[^}]*pod="([^"]+)",[^}]*node="([^"]+)",[^}]*resource="cpu"[^}]*}\s+([0-9.e+-]+)')
-    }
-
-    for line in ksm_lines:
-        for key, pattern in patterns.items():
-            match = pattern.search(line)
-            if match:
-                ns, pod, node, val = match.groups()
-                val = float(val)
-                if 'memory' in key:
-                    val /= 1024 ** 2
-                resource_data[ns][pod][key] = val
-                node_totals[node][key] += val
+    for m in KSM_RESOURCE_RE.finditer(ksm_text):
+        kind, label_str, val = m.groups()
+        labels = dict(LABEL_RE.findall(label_str))
+        ns, pod, node, resource = labels.get("namespace"), labels.get("pod"), labels.get("node"), labels.get("resource")
+        if not ns or not pod or not node or resource not in ("cpu", "memory"):
+            continue
+        key = f"{resource}_{kind[:-1]}"  # requests -> memory_request, ...
+        val = float(val)
+        if resource == "memory":
+            val /= 1024 ** 2
+        resource_data.setdefault((ns, pod), {})[key] = val
+        node_totals[node][key] += val
 
     return resource_data, node_totals
 
+# Requests/limits move on a minutes scale, so the KSM download and parse is
+# reused between scrapes and only redone once it is older than the TTL
+KSM_TTL = 300
+
+class KSMCache:
+    def __init__(self, ttl=KSM_TTL):
+        self.ttl = ttl
+        self.value = None
+        self.fetched_at = 0.0
+
+    def get(self):
+        now = time.monotonic()
+        if self.value is None or now - self.fetched_at >= self.ttl:
+            self.value = parse_ksm_metrics(fetch_ksm_metrics())
+            self.fetched_at = now
+        return self.value
+
+# Pod metadata is listed once and then kept current from a watch in a
+# background thread, instead of going stale after startup
+def watch_pod_metadata(v1, owner_info, container_info, node_map):
+    def apply(pod):
+        key = (pod.metadata.namespace, pod.metadata.name)
+        owner = pod.metadata.owner_references
+        owner_info[key] = owner[0].kind if owner else "None"
+        node_map[key] = pod.spec.node_name
+        container_info[key] = [c.name for c in pod.spec.containers]
+        return key
+
+    def forget(key):
+        owner_info.pop(key, None)
+        node_map.pop(key, None)
+        container_info.pop(key, None)
+
+    def relist():
+        pods = v1.list_pod_for_all_namespaces()
+        seen = {apply(pod) for pod in pods.items}
+        for key in list(owner_info):
+            if key not in seen:
+                forget(key)
+        return pods.metadata.resource_version
+
+    def run(resource_version):
+        w = watch.Watch()
+        while True:
+            try:
+                if resource_version is None:
+                    resource_version = relist()
+                for event in w.stream(v1.list_pod_for_all_namespaces,
+                                      resource_version=resource_version, timeout_seconds=0):
+                    pod = event["object"]
+                    resource_version = pod.metadata.resource_version
+                    if event["type"] == "DELETED":
+                        forget((pod.metadata.namespace, pod.metadata.name))
+                    else:
+                        apply(pod)
+            except ApiException as e:
+                if e.status != 410:  # anything but "resource version too old"
+                    print(f"⚠️ Pod watch failed: {e}")
+                    time.sleep(5)
+                resource_version = None
+            except Exception as e:
+                print(f"⚠️ Pod watch failed: {e}")
+                time.sleep(5)
+
+    resource_version = relist()
+    threading.Thread(target=run, args=(resource_version,), daemon=True).start()
+
+# Per-container cpu rate between consecutive scrapes. Each container keeps a
+# fixed slot in the prev/curr arrays across iterations, so every
+# delta_cpu / delta_time is one vectorised divide over aligned arrays.
+class CpuRateTracker:
+    def __init__(self):
+        self.index = {}  # (ns, pod, container) -> slot
+        self.keys = []
+        self.prev_cpu = np.empty(0)
+        self.prev_ts = np.empty(0)
+
+    def update(self, metrics):
+        for key in metrics:
+            if key not in self.index:
+                self.index[key] = len(self.keys)
+                self.keys.append(key)
+        n = len(self.keys)
+        # Slots for new containers start as NaN, i.e. "no previous sample"
+        grow = n - len(self.prev_cpu)
+        if grow:
+            self.prev_cpu = np.concatenate((self.prev_cpu, np.full(grow, np.nan)))
+            self.prev_ts = np.concatenate((self.prev_ts, np.full(grow, np.nan)))
+
+        curr_cpu = np.full(n, np.nan)
+        curr_ts = np.full(n, np.nan)
+        for key, m in metrics.items():
+            if "cpu" in m:
+                i = self.index[key]
+                curr_cpu[i] = m["cpu"]
+                curr_ts[i] = m["timestamp"]
+
+        missing = np.isnan(curr_cpu)
+        seen = ~(missing | np.isnan(self.prev_cpu))
+        dt = curr_ts - self.prev_ts
+        rates = np.divide(curr_cpu - self.prev_cpu, dt, out=np.zeros(n), where=seen & (dt > 0))
+        self.prev_cpu, self.prev_ts = curr_cpu, curr_ts
+
+        # Back to (key, rate) pairs for the containers sampled in both scrapes
+        keys = self.keys
+        result = [(keys[i], rate) for i, rate in zip(np.flatnonzero(seen).tolist(), rates[seen].tolist())]
+
+        # A slot with no cpu sample this scrape cannot yield a rate next
+        # time either, so dropping it loses nothing. Compact once such slots
+        # pass a quarter of the table, so pod churn cannot grow it forever.
+        if np.count_nonzero(missing) * 4 > n:
+            live = np.flatnonzero(~missing)
+            self.keys = [keys[i] for i in live.tolist()]
+            self.index = {key: i for i, key in enumerate(self.keys)}
+            self.prev_cpu, self.prev_ts = curr_cpu[live], curr_ts[live]
+        return result
+
+# Shared read-only fallback for pods with no KSM requests/limits
+EMPTY = {}
+
 # --- Main Loop ---
 if __name__ == "__main__":
     config.load_kube_config()
@@ -83,24 +176,17 @@ if __name__ == "__main__":
     owner_info = {}
     container_info = defaultdict(list)
     node_map = {}
+    watch_pod_metadata(v1, owner_info, container_info, node_map)
+    ksm_cache = KSMCache()
 
-    for pod in v1.list_pod_for_all_namespaces().items:
-        ns, name = pod.metadata.namespace, pod.metadata.name
-        owner = pod.metadata.owner_references
-        kind = owner[0].kind if owner else "None"
-        owner_info[(ns, name)] = kind
-        node_map[(ns, name)] = pod.spec.node_name
-        for c in pod.spec.containers:
-            container_info[(ns, name)].append(c.name)
-
-    prev_metrics = fetch_cadvisor_metrics()
+    cpu_rates = CpuRateTracker()
+    cpu_rates.update(fetch_cadvisor_metrics())
     time.sleep(60)
 
     while True:
         now = datetime.now(timezone.utc).isoformat()
         curr_metrics = fetch_cadvisor_metrics()
-        ksm_metrics = fetch_ksm_metrics()
-        resource_data, node_totals = parse_ksm_metrics(ksm_metrics)
+        resource_data, node_totals = ksm_cache.get()
 
         payload = {
             "timestamp": now,
@@ -108,31 +194,27 @@ if __name__ == "__main__":
             "nodes": []
         }
 
-        for key in curr_metrics:
-            if key in prev_metrics and "cpu" in curr_metrics[key] and "cpu" in prev_metrics[key]:
-                ns, pod, container = key
-                delta_cpu = curr_metrics[key]["cpu"] - prev_metrics[key]["cpu"]
-                delta_time = curr_metrics[key]["timestamp"] - prev_metrics[key]["timestamp"]
-                cpu_rate = delta_cpu / delta_time if delta_time > 0 else 0.0
-                mem = curr_metrics[key].get("memory", 0.0)
-
-                kind = owner_info.get((ns, pod), "Unknown")
-                node = node_map.get((ns, pod), "unknown")
-                metrics = resource_data.get(ns, {}).get(pod, {})
-
-                payload["containers"].append({
-                    "namespace": ns,
-                    "pod": pod,
-                    "node": node,
-                    "container": container,
-                    "kind": kind,
-                    "cpu_usage": cpu_rate,
-                    "memory_usage": mem,
-                    "cpu_request": metrics.get('cpu_request', 0.0),
-                    "cpu_limit": metrics.get('cpu_limit', 0.0),
-                    "memory_request": metrics.get('memory_request', 0.0),
-                    "memory_limit": metrics.get('memory_limit', 0.0)
-                })
+        for key, cpu_rate in cpu_rates.update(curr_metrics):
+            ns, pod, container = key
+            mem = curr_metrics[key].get("memory", 0.0)
+
+            kind = owner_info.get((ns, pod), "Unknown")
+            node = node_map.get((ns, pod), "unknown")
+            metrics = resource_data.get((ns, pod), EMPTY)
+
+            payload["containers"].append({
+                "namespace": ns,
+                "pod": pod,
+                "node": node,
+                "container": container,
+                "kind": kind,
+                "cpu_usage": cpu_rate,
+                "memory_usage": mem,
+                "cpu_request": metrics.get('cpu_request', 0.0),
+                "cpu_limit": metrics.get('cpu_limit', 0.0),
+                "memory_request": metrics.get('memory_request', 0.0),
+                "memory_limit": metrics.get('memory_limit', 0.0)
+            })
 
         for node, metrics in node_totals.items():
             payload["nodes"].append({
@@ -144,10 +226,12 @@ if __name__ == "__main__":
             })
 
         try:
-            res = requests.post("http://<YOUR-APP-HOST>:<PORT>/ingest", json=payload)
+            # orjson encodes straight to bytes; SESSION keeps the connection
+            # to the ingest host open between cycles
+            res = SESSION.post("http://<YOUR-APP-HOST>:<PORT>/ingest", data=orjson.dumps(payload),
+                               headers={"Content-Type": "application/json"})
             print(f"[{now}] Sent {len(payload['containers'])} containers, {len(payload['nodes'])} nodes. Status: {res.status_code}")
         except Exception as e:
             print(f"❌ Failed to send metrics: {e}")
 
-        prev_metrics = curr_metrics
         time.sleep(60)
@@ -0,0 +1,32 @@
+import pytest
+
+from scraper import CpuRateTracker
+
+
+def sample(cpu, ts):
+    return {"cpu": cpu, "timestamp": ts}
+
+
+def test_rates_for_containers_seen_in_both_scrapes():
+    tracker = CpuRateTracker()
+    assert tracker.update({("ns", "a", "c"): sample(10.0, 0.0)}) == []
+    rates = tracker.update({
+        ("ns", "a", "c"): sample(25.0, 30.0),
+        ("ns", "b", "c"): sample(5.0, 30.0),
+    })
+    assert rates == [(("ns", "a", "c"), pytest.approx(0.5))]
+
+
+def test_slots_stay_bounded_under_pod_churn():
+    tracker = CpuRateTracker()
+    stable = {("ns", f"stable-{i}", "c"): i for i in range(10)}
+    for cycle in range(500):
+        ts = cycle * 30.0
+        metrics = {key: sample(ts * i, ts) for key, i in stable.items()}
+        # Every cycle a fresh set of pods replaces the previous one
+        metrics.update({("ns", f"churn-{cycle}-{i}", "c"): sample(1.0, ts) for i in range(5)})
+        rates = dict(tracker.update(metrics))
+        if cycle:
+            assert set(rates) == set(stable)
+        assert len(tracker.keys) <= 2 * len(metrics)
+        assert len(tracker.index) == len(tracker.keys) == len(tracker.prev_cpu)
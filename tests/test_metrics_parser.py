@@ -0,0 +1,28 @@
+import pytest
+
+from metrics_parser import container_key
+
+
+@pytest.mark.parametrize("label_part, expected", [
+    # cAdvisor's usual sorted order: the find fast path
+    ('container="app",cpu="total",id="/kubepods/x",image="nginx:1",name="abc",namespace="default",pod="web-1"',
+     ("default", "web-1", "app")),
+    ('container="",id="/kubepods/pod1",namespace="kube-system",pod="p"', ("kube-system", "p", "")),
+    # No container labels at all (e.g. the root cgroup)
+    ('id="/"', ("", "", "")),
+    # Builds that only expose the container_label_io_kubernetes_* names
+    ('container_label_io_kubernetes_container_name="c",container_label_io_kubernetes_pod_name="p",'
+     'container_label_io_kubernetes_pod_namespace="n",id="/x"', ("n", "p", "c")),
+    # Plain labels win over the container_label_* fallbacks
+    ('container="c",container_label_io_kubernetes_pod_name="other",namespace="n",pod="p"', ("n", "p", "c")),
+    # Out of order: the generic path still resolves every label
+    ('pod="p",namespace="n",container="c"', ("n", "p", "c")),
+    # Suffix-named labels must not be taken for pod=/namespace=
+    ('container="c",namespace="n",pod_namespace="zz",pod="p"', ("n", "p", "c")),
+    ('container="c",image_pod="zz",namespace="n",pod="p"', ("n", "p", "c")),
+    ('container="c",namespace="n",pod_namespace="zz"', ("n", "", "c")),
+    ('container="c",image_pod="zz",namespace="n"', ("n", "", "c")),
+    ('image_container="zz",namespace="n",pod="p"', ("n", "p", "")),
+])
+def test_container_key(label_part, expected):
+    assert container_key(label_part) == expected